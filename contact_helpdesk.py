@@ -7,7 +7,8 @@
 
 #Be sure to configure the email_from and email_to variables with valid email addresses.
 #This script assumes that the database schema has a table named contact_queue with the following columns:
-#Contact_ID, Contact_Type, Contact_Fname, Contact_Lname, Contact_Email, Contact_DOB, Contact_Question, Contact_Response, Final_Prompt, Final_Response, Evaluation, Creation_Date, Processed_Date, Status, Payload
+#Contact_ID, Contact_Type, Contact_Fname, Contact_Lname, Contact_Email, Contact_DOB, Contact_Question, Contact_Response, Final_Prompt, Final_Response, Evaluation, Creation_Date, Processed_Date, Status, Payload, LLM_Type, Trace_ID
+#LLM_Type and Trace_ID are generated columns extracted from Payload, see sql_tables.sql
 
 # Author: Mike Tremaine 
 # Date: 2024-07-17 
@@ -16,15 +17,26 @@
 
 #Import the necessary libraries
 import streamlit as st
-import pandas as pd
+import datetime
 import json
-import mysql.connector
+import string
+import logging
+import os
+import threading
+from contextlib import closing
 
 #Import the shared functions
 from contact_utils import load_json_config, connect_to_mysql, initialize_baserun, send_generic_baserun_message, send_email_via_sendgrid, send_baserun_openai_query, send_baserun_tag
 
 # Import the function from google_rag_query.py
-from google_rag_query import get_rag_response, get_rag_prompt 
+from google_rag_query import get_rag_response, get_rag_prompt, load_rag_handle, NO_INFO_REPLY
+from semantic_cache import warm_embeddings
+
+from baserun import ApiClient
+
+# Debug output is off unless LOG_LEVEL=DEBUG is set in the environment
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper())
+log = logging.getLogger(__name__)
 
 # Global variables
 corpus_config_path = 'corpus_config.json' #This is generated by create_google_rag.py rename it as needed
@@ -32,10 +44,29 @@ credentials_path = 'key.json' #Google Service Account key file
 config_path = "config.json" #Main configuration file database, sendgrid, baserun, etc.
 
 # Email variable needs CC/BCC and email_to if from database. -mgt
+# email_to may also be a list, each address gets its own copy in a single SendGrid request
 email_from = "user@example.com"
 email_to = "user@example.com"
 subject = "Response to your inquiry"
 
+# Translation table escaping dollar signs so st.markdown does not treat them as LaTeX
+MARKDOWN_ESCAPE = str.maketrans({"$": "\\$"})
+
+# Helpdesk response email, built once and filled in by return_template
+EMAIL_TEMPLATE = string.Template("""Dear $name,
+
+Thank you for your inquiry.
+
+You asked our helpdesk the following question:
+$question
+
+$response
+
+If you have any further questions, please feel free to contact us.
+
+Best regards,
+Your Helpdesk Team""")
+
 def clicked_close_submission(config, submission_id, submission_details):
     """
     Closes a submission and sends an email notification via sendgrid. 
@@ -70,13 +101,16 @@ def clicked_get_rag(config, corpus_config_path, credentials_path, submission_id)
         None
     """
     #print to console debug info
-    print("Fetching RAG/LLM response...")
-    rag_prompt, rag_response = get_rag_response(corpus_config_path, credentials_path, config, submission_id)  # Assuming this function exists and returns the response
-    print(rag_response)
-    update_submission(config, submission_id, "Contact_Response", rag_response)
-    update_submission(config, submission_id, "Final_Prompt", rag_prompt)
-    update_submission(config, submission_id, "Status", "Processed")
-    update_submission(config, submission_id, "Payload", "JSON_INSERT(@`Payload`, '$.llm', 'gemini-1.5-pro-001')")
+    log.debug("Fetching RAG/LLM response...")
+    corpus_config = get_rag_handle(corpus_config_path, credentials_path)
+    # Stream the answer into the page as it is generated
+    placeholder = st.empty()
+    rag_prompt, rag_response = get_rag_response(corpus_config, config, submission_id, on_token=placeholder.markdown)
+    placeholder.empty()
+    log.debug("RAG/LLM response: %s", rag_response)
+    fields = {"Contact_Response": rag_response, "Final_Prompt": rag_prompt, "Status": "Processed"}
+    llm = "none" if rag_response == NO_INFO_REPLY else "gemini-1.5-pro-001"
+    update_submission_multi(config, submission_id, fields, {"llm": llm})
     st.success("RAG/LLM response fetched and submission updated.")
 
 def clicked_get_openai(config, corpus_config_path, credentials_path, submission_id, submission_details):
@@ -95,16 +129,25 @@ def clicked_get_openai(config, corpus_config_path, credentials_path, submission_
     """
     contact_id = submission_details['Contact_ID'] #double check this 
     #print to console debug info
-    print("Fetching RAG response...")
-    prompt = get_rag_prompt(corpus_config_path, credentials_path, config, contact_id)
-    print("Fetching OpenAI response...")
-    response, trace_id = send_baserun_openai_query(config, prompt)
-    print(response)
-    update_submission(config, submission_id, "Contact_Response", response)
-    update_submission(config, submission_id, "Final_Prompt", prompt)
-    update_submission(config, submission_id, "Status", "Processed")
-    update_submission_payload(config, submission_id, "llm", "openai")
-    update_submission_payload(config, submission_id, "trace_id", trace_id)
+    log.debug("Fetching RAG response...")
+    corpus_config = get_rag_handle(corpus_config_path, credentials_path)
+    # The question is already in hand so the corpus lookup overlaps the database fetch
+    question = submission_details['Contact_Question']
+    prompt, response = get_rag_prompt(corpus_config, config, contact_id, question)
+    if response is not None:
+        # No corpus context and no member data, the canned reply is used and OpenAI is not called
+        fields = {"Contact_Response": response, "Final_Prompt": prompt, "Status": "Processed"}
+        update_submission_multi(config, submission_id, fields, {"llm": "none"})
+        st.success("No information to answer with, submission updated.")
+        return
+    log.debug("Fetching OpenAI response...")
+    # Stream the answer into the page as it is generated
+    placeholder = st.empty()
+    response, trace_id = send_baserun_openai_query(config, prompt, on_token=placeholder.markdown)
+    placeholder.empty()
+    log.debug("OpenAI response: %s", response)
+    fields = {"Contact_Response": response, "Final_Prompt": prompt, "Status": "Processed"}
+    update_submission_multi(config, submission_id, fields, {"llm": "openai", "trace_id": trace_id})
     st.success("OpenAI response fetched and submission updated.")
 
 def clicked_submit_response(config, submission_id, submission_details, prompt):
@@ -120,26 +163,16 @@ def clicked_submit_response(config, submission_id, submission_details, prompt):
     Returns:
     None
     """
-    #decode json payload to payload
-    try:
-        if submission_details['Payload']:
-            payload = json.loads(submission_details['Payload'])
-        else:
-            payload = {}
-    except json.JSONDecodeError:
-        payload = {}
-        st.warning("Invalid JSON payload. Unable to parse.")
     response = st.session_state[f"final_{submission_id}"] 
-    update_submission(config, submission_id, "Final_Response", response)
     evaluation = st.session_state[f"slider_{submission_id}"]
-    update_submission(config, submission_id, "Evaluation", evaluation)
+    update_submission_multi(config, submission_id, {"Final_Response": response, "Evaluation": evaluation})
     #call baserun
-    baserun_client = initialize_baserun(config) 
-    model_name = "gemini-1.5-pro-001" # model name as global?
-    print(payload)
-    if 'llm' in payload and payload['llm'] == 'openai':
-        send_baserun_tag(config, evaluation, payload)
-    else:
+    # LLM_Type and Trace_ID are generated from Payload by MySQL, no JSON parsing needed here
+    if submission_details['LLM_Type'] == 'openai':
+        send_baserun_tag(config, evaluation, {"trace_id": submission_details['Trace_ID']})
+    elif submission_details['LLM_Type'] != 'none': # 'none' is the canned NO_INFO_REPLY, no completion to report
+        baserun_client = initialize_baserun(config, get_baserun_api_client(config))
+        model_name = "gemini-1.5-pro-001" # model name as global?
         send_generic_baserun_message(baserun_client, model_name, prompt, response, evaluation)
     st.success("Response updated and email prepared.")
 
@@ -162,10 +195,12 @@ def display_email_details(submission_details, response):
     st.write("**Body:**")
     #email_body as markdown
     #escape dollar signs from email_body
-    email_body = email_body.replace("$", "\$")
+    email_body = email_body.translate(MARKDOWN_ESCAPE)
     st.markdown(email_body)
 
 
+# Fragments rerun on their own when a widget inside them changes, not the whole script
+@st.fragment
 def display_submissions(config):
     """
     Display the waiting submissions.
@@ -177,13 +212,16 @@ def display_submissions(config):
     None
     """
     # Fetch the waiting submissions 
-    df = fetch_waiting_submissions(config)
+    rows = fetch_waiting_submissions(config)
     st.title("Waiting Submissions")
+    # Drop the cached list so the next rerun reads from the database
+    st.button("Refresh", on_click=fetch_waiting_submissions.clear)
     #loop through the submissions
-    if not df.empty:
-        for index, row in df.iterrows():
+    if rows:
+        for row in rows:
             # Use the Contact_ID as the button label and display additional info below if clicked
-            if st.button(f"Contact ID: {row['Contact_ID']}", key=row['Contact_ID']):
+            label = f"Contact ID: {row['Contact_ID']} - {row['Contact_Type']} ({row['Contact_Fname']} {row['Contact_Lname']})"
+            if st.button(label, key=row['Contact_ID']):
             # Clear the placeholder to simulate clearing the screen
                 placeholder = st.empty()
                 placeholder.empty()
@@ -203,18 +241,18 @@ def fetch_submission_details(config, submission_id):
         dict or None: A dictionary containing the details of the submission if found, 
                       or None if no submission with the given ID exists.
     """
-    conn = connect_to_mysql(config)
-    cursor = conn.cursor()
-    query = "SELECT * FROM contact_queue WHERE Contact_ID = %s"
-    cursor.execute(query, (submission_id,))
-    row = cursor.fetchone()
-    cursor.close()
-    conn.close()
-    if row:
-        return dict(zip(['Contact_ID', 'Contact_Type', 'Contact_Fname', 'Contact_Lname', 'Contact_Email', 'Contact_DOB', 'Contact_Question', 'Contact_Response','Final_Prompt','Final_Response','Evaluation','Creation_Date', 'Processed_Date', 'Status', 'Payload'], row))
-    return None
+    # closing() returns the connection to the pool even if a query fails
+    with closing(connect_to_mysql(config)) as conn:
+        # dictionary cursor returns rows keyed by column name
+        with conn.cursor(dictionary=True) as cursor:
+            query = "SELECT * FROM contact_queue WHERE Contact_ID = %s"
+            cursor.execute(query, (submission_id,))
+            row = cursor.fetchone()
+    return row
 
 # Function to fetch waiting submissions from the database
+# Cached for a short time since every widget interaction reruns the script
+@st.cache_data(ttl=30, show_spinner=False)
 def fetch_waiting_submissions(config):
     """
     Fetches the waiting submissions from the contact_queue table in the database.
@@ -223,60 +261,81 @@ def fetch_waiting_submissions(config):
         config (dict): A dictionary containing the configuration details for connecting to the database.
 
     Returns:
-        pandas.DataFrame: A DataFrame containing the fetched rows from the contact_queue table.
-            The DataFrame has the following columns:
+        list: A list of dicts, one per fetched row from the contact_queue table.
+            Only the summary columns needed for the listing are selected, use
+            fetch_submission_details for the full row. Each dict has the following keys:
             - Contact_ID: The ID of the contact.
             - Contact_Type: The type of contact.
             - Contact_Fname: The first name of the contact.
             - Contact_Lname: The last name of the contact.
-            - Contact_Email: The email of the contact.
-            - Contact_DOB: The date of birth of the contact.
-            - Contact_Question: The question asked by the contact.
-            - Contact_Response: The response given to the contact.
-            - Final_Prompt: The final prompt given to the contact.
-            - Final_Response: The final response given to the contact.
-            - Evaluation: The evaluation of the contact.
-            - Creation_Date: The date of creation of the contact.
-            - Processed_Date: The date when the contact was processed.
             - Status: The status of the contact.
-            - Payload: The payload of the contact.
     """
-    conn = connect_to_mysql(config)
-    cursor = conn.cursor()
-    query = "SELECT * FROM contact_queue WHERE Status <> 'Closed'"
-    cursor.execute(query)
-    rows = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    # Adjust column names based on the actual database schema
-    return pd.DataFrame(rows, columns=['Contact_ID', 'Contact_Type', 'Contact_Fname', 'Contact_Lname', 'Contact_Email', 'Contact_DOB', 'Contact_Question', 'Contact_Response','Final_Prompt','Final_Response','Evaluation','Creation_Date', 'Processed_Date', 'Status', 'Payload'])
+    with closing(connect_to_mysql(config)) as conn:
+        # dictionary cursor so the column names come from the driver
+        with conn.cursor(dictionary=True) as cursor:
+            # A positive status list lets MySQL range scan the Status index instead of the whole table
+            query = "SELECT Contact_ID, Contact_Type, Contact_Fname, Contact_Lname, Status FROM contact_queue WHERE Status IN ('Open', 'Processed')"
+            cursor.execute(query)
+            rows = cursor.fetchall()
+    return rows
+
+@st.cache_resource
+def get_baserun_api_client(config):
+    """
+    Returns the authenticated baserun API client, created once and shared across reruns.
 
-def insert_submission(config, contact_type, fname, lname, email, dob, comment, date):
+    Each submission still gets its own GenericClient (and trace) from initialize_baserun.
+
+    Args:
+        config (dict): The configuration settings containing the baserun key.
+
+    Returns:
+        ApiClient: The baserun API client.
+    """
+    return ApiClient(api_key=config["baserun_key"])
+
+@st.cache_resource
+def get_rag_handle(corpus_config_path, credentials_path):
+    """
+    Loads the corpus configuration and initializes Vertex AI once, shared across reruns.
+
+    Args:
+        corpus_config_path (str): The path to the corpus configuration.
+        credentials_path (str): The path to the credentials.
+
+    Returns:
+        dict: The corpus handle passed to the google_rag_query functions.
     """
-    Insert a submission into the contact_queue table.
+    return load_rag_handle(corpus_config_path, credentials_path)
+
+def insert_submission(config, submissions):
+    """
+    Insert one or more submissions into the contact_queue table.
 
     Args:
         config (str): The configuration for connecting to the database.
-        contact_type (str): The type of contact.
-        fname (str): The first name of the contact.
-        lname (str): The last name of the contact.
-        email (str): The email of the contact.
-        dob (str): The date of birth of the contact.
-        comment (str): The comment/question of the contact.
-        date (datetime): The creation date of the submission.
+        submissions (iterable): Tuples of (contact_type, fname, lname, email, dob, comment, date) where
+            - contact_type (str): The type of contact.
+            - fname (str): The first name of the contact.
+            - lname (str): The last name of the contact.
+            - email (str): The email of the contact.
+            - dob (str): The date of birth of the contact.
+            - comment (str): The comment/question of the contact.
+            - date (datetime): The creation date of the submission.
 
     Returns:
         None
     """
-    date = date.strftime('%Y-%m-%d %H:%M:%S')
-    conn = connect_to_mysql(config)
-    cursor = conn.cursor()
-    query = "INSERT INTO contact_queue (Contact_Type, Contact_Fname, Contact_Lname, Contact_Email, Contact_DOB, Contact_Question, Creation_Date) VALUES (%s, %s, %s, %s, %s, %s, %s)"
-    cursor.execute(query, (contact_type, fname, lname, email, dob, comment, date))
-    conn.commit()
-    cursor.close()
-    conn.close()
+    rows = [(*submission[:-1], submission[-1].strftime('%Y-%m-%d %H:%M:%S')) for submission in submissions]
+    with closing(connect_to_mysql(config)) as conn:
+        with conn.cursor() as cursor:
+            # executemany rewrites this into a single multi-row INSERT ... VALUES (...),(...)
+            query = "INSERT INTO contact_queue (Contact_Type, Contact_Fname, Contact_Lname, Contact_Email, Contact_DOB, Contact_Question, Creation_Date) VALUES (%s, %s, %s, %s, %s, %s, %s)"
+            cursor.executemany(query, rows)
+        conn.commit()
+    fetch_waiting_submissions.clear()
 
+@st.fragment
 def load_submission_details(config, submission_id):
     """
     Loads the submission details for a given submission ID.
@@ -288,6 +347,7 @@ def load_submission_details(config, submission_id):
     Returns:
     - None
     """
+    # Fetched inside the fragment so reruns after a button click see the updated row
     submission_details = fetch_submission_details(config, submission_id)
     evaluation_key = f"evaluation_{submission_id}"
     submitted_key = f"submitted_{submission_id}"
@@ -330,7 +390,7 @@ def load_submission_details(config, submission_id):
                 st.write("Prompt:")
                 #escape dollar signs from prompt
                 if submission_details['Final_Prompt']:
-                    prompt = st.markdown(submission_details['Final_Prompt'].replace("$", "\$"))
+                    prompt = st.markdown(submission_details['Final_Prompt'].translate(MARKDOWN_ESCAPE))
                 else: 
                     prompt = st.markdown(submission_details['Final_Prompt'])
 
@@ -351,6 +411,7 @@ def load_submission_details(config, submission_id):
                     st.session_state[submitted_key] = st.form_submit_button("Submit Response", on_click=clicked_submit_response, args=(config, submission_id, submission_details, prompt))
 
 
+@st.fragment
 def member_contact_form(config):
     """
     Renders a member contact form using Streamlit.
@@ -370,13 +431,29 @@ def member_contact_form(config):
         email = st.text_input("Email")
         dob = st.date_input("Date of Birth")
         comment = st.text_area("Question or Comment?", height=100)
-        date = pd.to_datetime("today")
+        date = datetime.datetime.now()
         submitted = st.form_submit_button("Submit")
 
         if submitted and contact_type and fname and lname and email and comment:
-            insert_submission(config, contact_type, fname, lname, email, dob, comment, date)
+            insert_submission(config, [(contact_type, fname, lname, email, dob, comment, date)])
             st.success("Submission successful!")
         
+def payload_json_set(payload_updates):
+    """
+    Builds a JSON_SET expression that merges keys into the Payload column.
+
+    Args:
+        payload_updates (dict): The payload keys to set and their new values.
+
+    Returns:
+        tuple: The SQL expression and the list of values to bind to it.
+    """
+    json_args = ", ".join(["%s, CAST(%s AS JSON)"] * len(payload_updates))
+    values = []
+    for key, value in payload_updates.items():
+        values.extend([f"$.{key}", json.dumps(value)])
+    return f"JSON_SET(COALESCE(Payload, '{{}}'), {json_args})", values
+
 def return_template(submission_details, response):
     """
     Generates a template for a helpdesk response.
@@ -391,64 +468,55 @@ def return_template(submission_details, response):
     Returns:
         str: The generated template for the helpdesk response.
     """
-
-
-
-
-
-
     user_name = submission_details['Contact_Fname'] + " " + submission_details['Contact_Lname']
-    question = submission_details['Contact_Question']
-    content = f"""Dear {user_name},
-
-Thank you for your inquiry.
-
-You asked our helpdesk the following question:
-{question}
+    return EMAIL_TEMPLATE.substitute(name=user_name, question=submission_details['Contact_Question'], response=response)
 
-{response}
-
-If you have any further questions, please feel free to contact us.
+@st.cache_resource
+def start_embedding_warmup(config):
+    """
+    Starts warm_question_embeddings on a background thread, once per process.
+    Runs at app startup, the page does not wait for Vertex AI to load or the warm up to finish.
 
-Best regards,
-Your Helpdesk Team"""
+    Args:
+        config (dict): The configuration for connecting to the database.
 
-    return content
+    Returns:
+        threading.Thread: The warm up thread.
+    """
+    thread = threading.Thread(target=warm_question_embeddings, args=(config,), daemon=True)
+    thread.start()
+    return thread
 
-def update_submission_payload(config, submission_id, key, value):
+def update_submission_multi(config, submission_id, fields, payload_updates=None):
     """
-    Update the payload of a submission in the contact_queue table.
+    Update several fields of a submission in the contact_queue table with a single UPDATE statement.
 
     Args:
         config (dict): The configuration settings for connecting to the MySQL database.
         submission_id (int): The ID of the submission to update.
-        key (str): The key of the payload to update.
-        value (str): The new value for the payload key.
-
-    Raises:
-        ValueError: If no submission is found with the given ID.
-    """
-    conn = connect_to_mysql(config)
-    cursor = conn.cursor()
-    query = "SELECT Payload FROM contact_queue WHERE Contact_ID = %s"
-    cursor.execute(query, (submission_id,))
-    row = cursor.fetchone()
-    if row:
-        if row[0]:
-            payload = json.loads(row[0])
-        else:
-            payload = {}
-        payload[key] = value
-        payload_json = json.dumps(payload)
-        update_query = "UPDATE contact_queue SET Payload = %s WHERE Contact_ID = %s"
-        cursor.execute(update_query, (payload_json, submission_id))
+        fields (dict): Mapping of column names to their new values.
+        payload_updates (dict): Optional. Keys to set inside the Payload JSON and their new values,
+            keys whose value is None are left unchanged.
+
+    Returns:
+        None
+    """
+    log.debug("Updating submission %s with %s payload %s", submission_id, fields, payload_updates)
+    set_clauses = [f"{field_name} = %s" for field_name in fields]
+    values = list(fields.values())
+    # None would be stored as JSON null, which the generated columns read as the string 'null'
+    payload_updates = {key: value for key, value in (payload_updates or {}).items() if value is not None}
+    if payload_updates:
+        payload_sql, payload_values = payload_json_set(payload_updates)
+        set_clauses.append(f"Payload = {payload_sql}")
+        values.extend(payload_values)
+    values.append(submission_id)
+    with closing(connect_to_mysql(config)) as conn:
+        with conn.cursor() as cursor:
+            query = f"UPDATE contact_queue SET {', '.join(set_clauses)} WHERE Contact_ID = %s"
+            cursor.execute(query, tuple(values))
         conn.commit()
-        cursor.close()
-        conn.close()
-    else:
-        cursor.close()
-        conn.close()
-        raise ValueError(f"No submission found with ID: {submission_id}")
+    fetch_waiting_submissions.clear()
 
 def update_submission(config, submission_id, field_name, input_value):
     """
@@ -463,19 +531,39 @@ def update_submission(config, submission_id, field_name, input_value):
     Returns:
         None
     """
-    print(f"Updating submission {submission_id} with {field_name} = {input_value}")
-    conn = connect_to_mysql(config)
-    cursor = conn.cursor()
-    query = f"UPDATE contact_queue SET {field_name} = %s WHERE Contact_ID = %s"
-    cursor.execute(query, (input_value, submission_id))
-    conn.commit()
-    cursor.close()
-    conn.close()
+    log.debug("Updating submission %s with %s = %s", submission_id, field_name, input_value)
+    with closing(connect_to_mysql(config)) as conn:
+        with conn.cursor() as cursor:
+            query = f"UPDATE contact_queue SET {field_name} = %s WHERE Contact_ID = %s"
+            cursor.execute(query, (input_value, submission_id))
+        conn.commit()
+    fetch_waiting_submissions.clear()
+
+def warm_question_embeddings(config):
+    """
+    Initializes Vertex AI and embeds the recent contact_queue questions in batches for the semantic cache,
+    see start_embedding_warmup. Best effort, a Vertex AI, database or embedding API error only logs a warning.
+    Vertex AI initialization is cached by google_rag_query, later get_rag_handle calls do not repeat it.
+
+    Args:
+        config (dict): The configuration for connecting to the database.
+
+    Returns:
+        None
+    """
+    try:
+        load_rag_handle(corpus_config_path, credentials_path)
+        count = warm_embeddings(config)
+    except Exception as e:
+        log.warning("Warming question embeddings failed: %s", e)
+        return
+    log.info("Warmed %d question embeddings", count)
 
 # Streamlit app main function
 def main():
     # Load the configuration settings
     config = load_json_config(config_path)
+    start_embedding_warmup(config)
     #Page navigation
     st.sidebar.title("Navigation")
     page = st.sidebar.selectbox("Go to", ["Member Contact Form", "Submission Details"])
@@ -488,5 +576,5 @@ def main():
     #Could make Review Closed Submissions a separate page
 
 if __name__ == "__main__":
-    print("Starting Streamlit app...")
-    main()
\ No newline at end of file
+    log.info("Starting Streamlit app...")
+    main()
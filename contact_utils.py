@@ -9,7 +9,10 @@
 # Description: This script contains utility functions for the contact_helpdesk and related rag lookup scripts.
 
 import os, json, markdown
-import mysql.connector
+import functools
+import logging
+import threading
+import time
 from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail
 from baserun import ApiClient, log, feedback, OpenAI
@@ -21,7 +24,23 @@ from baserun.wrappers.generic import (
     GenericInputMessage,
 )
 
+# baserun exports its own log() used for tagging below, so this module's logger is named logger
+logger = logging.getLogger(__name__)
+
+# Default number of pooled MySQL connections, override with "pool_size" in config.json
+DEFAULT_POOL_SIZE = 10
+
+# Module level connection pool, created on first use by connect_to_mysql
+_POOL = None
+# Guards pool creation, the helpdesk calls connect_to_mysql from worker threads as well
+_POOL_LOCK = threading.Lock()
+
+# Least seconds between on_token calls while a reply streams in, each call re-renders the whole reply
+STREAM_UPDATE_INTERVAL = 0.1
+
 #Import json from config_path
+#Parsed once per path and shared, callers must not modify the returned dict
+@functools.lru_cache(maxsize=8)
 def load_json_config(config_path):
     with open(config_path, 'r') as file:
         return json.load(file)
@@ -29,13 +48,47 @@ def load_json_config(config_path):
 # Function to connect to MySQL database
 def connect_to_mysql(config):
     # see config.json for values
-    my_conn = mysql.connector.connect(
-        host=config["servername"],
-        user=config["username"],
-        password=config["password"],
-        database=config["dbname"],
-    )
-    return my_conn
+    # Connections come from a shared pool, calling close() returns them to the pool
+    global _POOL
+    if _POOL is None:
+        with _POOL_LOCK:
+            # re-checked under the lock, a pool opens all its connections when it is created
+            if _POOL is None:
+                # imported here so scripts that only load config do not pay for the connector import
+                from mysql.connector.pooling import MySQLConnectionPool
+                _POOL = MySQLConnectionPool(
+                    pool_name="cq",
+                    pool_size=config.get("pool_size", DEFAULT_POOL_SIZE),
+                    host=config["servername"],
+                    user=config["username"],
+                    password=config["password"],
+                    database=config["dbname"],
+                )
+    return _POOL.get_connection()
+
+def collect_stream(chunks, on_token=None):
+    """
+    Joins streamed text chunks into the full reply.
+
+    Args:
+        chunks (iterable): The text chunks as they arrive.
+        on_token (callable): Optional. Called with the reply so far at most every
+            STREAM_UPDATE_INTERVAL seconds, and once more with the full reply.
+
+    Returns:
+        str: The full reply.
+    """
+    parts = []
+    last_update = time.monotonic()
+    for text in chunks:
+        parts.append(text)
+        if on_token and time.monotonic() - last_update >= STREAM_UPDATE_INTERVAL:
+            on_token("".join(parts))
+            last_update = time.monotonic()
+    reply = "".join(parts)
+    if on_token:
+        on_token(reply)
+    return reply
 
 #We export the keys to the environment used for none generic wrappers
 def initialize_global_baserun(config):
@@ -45,25 +98,30 @@ def initialize_global_baserun(config):
         os.environ["OPENAI_API_KEY"] = config["openai_key"]
 
 #This function initializes the baserun client directly
-def initialize_baserun(config):
+#Pass a long lived api_client to reuse its authenticated session between clients
+def initialize_baserun(config, api_client=None):
     # Initialize the baserun client, passing in the User Contact ID
     baserun_id = config["baserun_id"]
     baserun_key = config["baserun_key"]
+    if api_client is None:
+        api_client = ApiClient(api_key=baserun_key)
     baserun_client = GenericClient(
         name="Vision Benefits",
         user_id=baserun_id,
         # If you have the environment variable BASERUN_API_KEY set you can omit this next line
-        api_client=ApiClient(api_key=baserun_key),
+        api_client=api_client,
     )
     return baserun_client
 
-def send_baserun_openai_query(config, prompt):
+def send_baserun_openai_query(config, prompt, on_token=None):
     """
     Sends a query to OpenAI's chat completions API using the provided configuration and prompt.
 
     Args:
         config (dict): The configuration settings for the query.
         prompt (str): The prompt for the query.
+        on_token (callable): Optional. When given the response is streamed and this is
+            called with the text received so far, see collect_stream for how often.
 
     Returns:
         tuple: A tuple containing the response message content and the trace ID.
@@ -83,10 +141,20 @@ def send_baserun_openai_query(config, prompt):
                 "content": prompt, 
             }
         ],
+        stream=on_token is not None,
+    )
+    if on_token is None:
+        logger.debug("OpenAI completion: %s", completion)
+        return completion.choices[0].message.content, completion.trace_id
+
+    # Collect the streamed chunks, baserun submits the completion once the stream is exhausted
+    reply = collect_stream(
+        (chunk.choices[0].delta.content for chunk in completion
+         if chunk.choices and chunk.choices[0].delta.content),
+        on_token,
     )
-    print(completion) # Print the completion object to the console
-    trace_id = completion.trace_id
-    return completion.choices[0].message.content, trace_id
+    # read only after the stream is consumed, the wrapper is not documented to expose it any earlier
+    return reply, completion.trace_id
 
 def send_baserun_tag(config, evaluation, payload):
     """
@@ -141,9 +209,9 @@ def send_generic_baserun_message(baserun_client, model_name, prompt, response, e
     completion.submit_to_baserun()
     #Traces
 
-    print("Prompt:", prompt)
-    print("Response:", response)
-    print("Evaluation:", evaluation)
+    logger.debug("Prompt: %s", prompt)
+    logger.debug("Response: %s", response)
+    logger.debug("Evaluation: %s", evaluation)
     if evaluation:
         trace_id = baserun_client.trace_id
         log("Tagging resumed", trace_id=trace_id, )
@@ -158,7 +226,8 @@ def send_email_via_sendgrid(api_key, from_email, to_email, subject, content):
     Parameters:
     - api_key (str): The SendGrid API key.
     - from_email (str): The email address of the sender.
-    - to_email (str): The email address of the recipient.
+    - to_email (str or list): The email address of the recipient, or a list of addresses.
+      A list is sent as one request with a separate personalization per recipient.
     - subject (str): The subject of the email.
     - content (str): The content of the email in markdown format.
 
@@ -174,14 +243,16 @@ def send_email_via_sendgrid(api_key, from_email, to_email, subject, content):
     content = content.replace("markdown", "")
     #convert content from markdown to html
     content = markdown.markdown(content)
+    # is_multiple gives each recipient their own personalization, all sent in one API call
     message = Mail(
         from_email=from_email,
         to_emails=to_email,
         subject=subject,
-        html_content=content)
+        html_content=content,
+        is_multiple=isinstance(to_email, list))
     try:
         sg = SendGridAPIClient(api_key)
         response = sg.send(message)
-        print(f"Email sent! Status code: {response.status_code}")
+        logger.debug("Email sent, status code: %s", response.status_code)
     except Exception as e:
-        print(f"An error occurred: {e}")
+        logger.warning("Sending email failed: %s", e)
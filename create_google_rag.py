@@ -27,11 +27,16 @@
 
 import argparse, os, time
 import json
+from google.cloud import storage
+from google.cloud.storage import transfer_manager
+from google.oauth2 import service_account
 from vertexai.preview import rag
 import vertexai
 
 # Define a global default location
 DEFAULT_LOCATION = 'us-central1'
+# Number of parallel uploads to GCS
+UPLOAD_WORKERS = 16
 
 def initialize_vertex_ai(project_id, location=DEFAULT_LOCATION, credentials_path=None):
     if credentials_path:
@@ -71,12 +76,21 @@ def upload_files_to_gcs(bucket_name, display_name, source_dir, credentials_path)
     bucket = storage_client.bucket(bucket_name)
     uploaded_files = []
 
-    for filename in os.listdir(source_dir):
-        local_path = os.path.join(source_dir, filename)
-        #Upload file to GCS    
-        if os.path.isfile(local_path):
-            blob = bucket.blob(f"{display_name}/{filename}")
-            blob.upload_from_filename(local_path)
+    filenames = [f for f in os.listdir(source_dir) if os.path.isfile(os.path.join(source_dir, f))]
+    #Upload files to GCS in parallel, each upload is an independent request
+    results = transfer_manager.upload_many_from_filenames(
+        bucket,
+        filenames,
+        source_directory=source_dir,
+        blob_name_prefix=f"{display_name}/",
+        max_workers=UPLOAD_WORKERS,
+        worker_type=transfer_manager.THREAD,
+    )
+    # Each result is None on success or the exception raised for that file
+    for filename, result in zip(filenames, results):
+        if isinstance(result, Exception):
+            print(f"Failed to upload {filename}: {result}")
+        else:
             uploaded_files.append(filename)
             print(f"Uploaded {filename} to {bucket_name}/{display_name}")
 
@@ -9,89 +9,175 @@
 # Version: 1.0
 # License: MIT
 
-import argparse, os, time
+import argparse, os
 import json
-from vertexai.preview import rag
-from vertexai.preview.generative_models import GenerativeModel, Tool
-import vertexai
-import mysql.connector
-import pandas as pd
+import logging
+import string
+import hashlib
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import TTLCache, cached
+# vertexai and mysql.connector are slow to import, they are imported in the functions that use them
+# so the CLI --help and callers that never query do not pay for them
 
 #Import the shared functions
-from contact_utils import load_json_config, connect_to_mysql
+from contact_utils import load_json_config, connect_to_mysql, collect_stream
+from semantic_cache import embed_question, lookup_answer, store_answer
+
+log = logging.getLogger(__name__)
+
+# Corpus documents change slowly, retrieval results are reused for a day
+RETRIEVAL_CACHE_SIZE = 5000
+RETRIEVAL_CACHE_TTL = 24 * 3600
+
+# Client errors for a dropped connection, these are worth one retry on a fresh pooled connection
+# CR_SERVER_GONE_ERROR, CR_SERVER_LOST and CR_SERVER_LOST_EXTENDED in mysql.connector.errorcode
+RETRY_ERRNOS = (2006, 2013, 2055)
+
+# Columns read from contact_queue, these identify the member and carry the question
+SUBMISSION_COLUMNS = ("Contact_Email", "Contact_Fname", "Contact_Lname", "Contact_DOB", "Contact_Question")
+# Member_Data columns passed to the LLM as known_info, everything in here ends up in the prompt
+MEMBER_COLUMNS = (
+    "Brand_Member_ID", "Member_Name", "Email_Address", "Phone",
+    "Member_Since", "Member_Last_Purchase", "Plan_Type_Code", "IsInactive",
+)
+# Member_Found marks where the contact_queue columns end and the Member_Data columns start
+SUBMISSION_MEMBER_QUERY = (
+    "SELECT " + ", ".join("cq." + column for column in SUBMISSION_COLUMNS)
+    + ", md.Member_ID IS NOT NULL AS Member_Found, "
+    + ", ".join("md." + column for column in MEMBER_COLUMNS) + " FROM contact_queue cq "
+    "LEFT JOIN Member_Data md ON md.`Email_Address` = cq.Contact_Email "
+    "OR md.`Member_Name` = CONCAT(cq.Contact_Fname, ' ', cq.Contact_Lname) "
+    "WHERE cq.Contact_ID = %s LIMIT 1"
+)
 
 # Define a global default location
 DEFAULT_LOCATION = 'us-central1'
 
-def fetch_submission_details(config, contact_id):
-    mysql_conn = connect_to_mysql(config)
-    mem_cursor = mysql_conn.cursor()
-    try:
-        mem_cursor.execute(f"SELECT * FROM contact_queue WHERE Contact_ID = {contact_id}")
-        field_names = [desc[0] for desc in mem_cursor.description]
-        record = mem_cursor.fetchone()
-        submission_info = process_record(record, field_names)
-    except:
-        submission_info = {}
-
-    # close the cursor
-    mem_cursor.close()
-    #close connection
-    mysql_conn.close()
-    return submission_info
-
-def get_member_data(config, record_dict):
-    mysql_conn = connect_to_mysql(config)
-    # Get some possible identifying information
-    email = record_dict["Contact_Email"]
-    name = record_dict["Contact_Fname"] + " " + record_dict["Contact_Lname"]
-    dob = record_dict["Contact_DOB"]
-    # Write your query using the identifying information beware that you will be passing this
-    # to the LLM as additional context if there is PII in the data
-    mem_cursor = mysql_conn.cursor()
-    # handle no results with a try except block
-    try:
-        mem_cursor.execute(
-            f"SELECT * FROM Member_Data WHERE `Email_Address` = '{email}' OR `Member_Name` = '{name}'"
-        )
-        field_names = [desc[0] for desc in mem_cursor.description]
+#Set System
+SYSTEM_LIST = (
+    "You are an expert assistance extracting information from context provided.",
+    "Answer the question based on the context. Be concise and do not hallucinate.",
+    "Respond with the information you have in polite and professional manner.",
+    "If you do not have the information just say so and start the reply with [NONE].",
+    "Any query for Member ID or Member Number should use Brand_Member_ID as context but refer to it as Member ID.",
+    "Responsed in markdown format to make it easy to read.",
+)
+# Canned reply when neither the corpus nor the member data has anything to answer with,
+# the model would only reply [NONE] per SYSTEM_LIST so it is not called
+NO_INFO_REPLY = "[NONE] We do not have information to answer that question."
+# Joined once, prepended to every prompt we store
+SYSTEM_PREFIX = ' '.join(SYSTEM_LIST)
+
+# Prompt templates, filled with string.Template.substitute so braces in a question or context need no escaping
+ENHANCED_PROMPT_TEMPLATE = string.Template("""
+Context:  Additional data $known_info
+Question:  
+$question
+Answer: '
+""")
+RAG_PROMPT_TEMPLATE = string.Template("""
+Context: $rag_reply with Additional data $known_info
+Question:  
+$question
+Answer: '
+""")
+
+def fetch_one(config, query, params):
+    """
+    Run a query on a pooled connection and return the first row.
+    A dropped connection is retried once, any other mysql.connector.Error is raised to the caller.
 
-        # return the data as JSON string with the field names as keys
-        record = mem_cursor.fetchone()
-        known_info = process_record(record, field_names)
-    except:
-        known_info = {}
+    Args:
+        config (dict): The database configuration from config.json.
+        query (str): The SQL query with %s placeholders.
+        params (tuple): The query parameters.
 
-    # close the cursor
-    mem_cursor.close()
-    #close connection
-    mysql_conn.close()
-    return known_info
+    Returns:
+        dict: The first row keyed by column name, in select order, or None if nothing matched.
+    """
+    import mysql.connector
+
+    for attempt in range(2):
+        try:
+            # connect_to_mysql hands out pooled connections, close() returns it to the pool
+            mysql_conn = connect_to_mysql(config)
+            try:
+                # prepared cursor so the server parses and plans the statement once per connection
+                # dictionary rows are built by the connector as they are fetched
+                with mysql_conn.cursor(prepared=True, dictionary=True) as mem_cursor:
+                    mem_cursor.execute(query, params)
+                    return mem_cursor.fetchone()
+            finally:
+                # close() resets the session, which fails again on a dropped connection, the pool
+                # still takes the connection back and the original error is the one worth raising
+                try:
+                    mysql_conn.close()
+                except mysql.connector.Error as close_error:
+                    log.warning("Returning a MySQL connection to the pool failed: %s", close_error)
+        except mysql.connector.Error as e:
+            if attempt or e.errno not in RETRY_ERRNOS:
+                raise
+            log.warning("MySQL connection lost, retrying: %s", e)
+
+def fetch_submission_and_member(config, contact_id):
+    """
+    Fetch the submission and the matching Member_Data record in one query.
+    A member matches on the contact's email or full name, joined server side so it is a single round trip.
+
+    Returns a tuple of (submission_info, known_info), each {} if not found.
+    """
+    import mysql.connector
 
+    try:
+        record = fetch_one(config, SUBMISSION_MEMBER_QUERY, (contact_id,))
+    except mysql.connector.Error as e:
+        log.warning("Submission lookup failed for %s: %s", contact_id, e)
+        return {}, {}
+    if record is None:
+        return {}, {}
+    columns = list(record.items())
+    split = list(record).index("Member_Found")
+    submission_info = dict(columns[:split])
+    known_info = dict(columns[split + 1:]) if record["Member_Found"] else {}
+    return submission_info, known_info
+
+def format_known_info(known_info):
+    """
+    Serialize member data for a prompt as compact JSON, dates and decimals are written as strings.
+    JSON without the spaces of a Python dict repr is fewer tokens for the model.
+    """
+    return json.dumps(known_info, separators=(",", ":"), default=str)
+
+# Only the first call for a given project/location/credentials does any work
+@functools.lru_cache(maxsize=4)
 def initialize_vertex_ai(project_id, location=DEFAULT_LOCATION, credentials_path=None):
+    """Initializes Vertex AI with the given project ID and location."""
     if credentials_path:
         os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = credentials_path
-    """Initializes Vertex AI with the given project ID and location."""
+    import vertexai
     vertexai.init(project=project_id, location=location)
 
-def load_json_config(config_path):
-    with open(config_path, 'r') as file:
-        return json.load(file)
-
-def process_record(record, field_names):
+def load_rag_handle(corpus_config_path, credentials_path):
     """
-    Process a record fetched from the database and return a dictionary with field names as keys.
+    Loads the corpus configuration and initializes Vertex AI for it.
+    The returned corpus config is the handle passed to the query functions below.
     """
-    if record is None:
-        return {}
-            
-    processed_record = {}
-    for i, value in enumerate(record):
-        processed_record[field_names[i]] = value
-            
-    return processed_record
-
-def query_corpus(corpus_config, credentials_path, query_text):
+    corpus_config = load_json_config(corpus_config_path)
+    initialize_vertex_ai(corpus_config['project_id'], corpus_config['location'], credentials_path)
+    return corpus_config
+
+# Keyed by corpus and question hash, the config dict itself is not hashable
+@cached(
+    TTLCache(maxsize=RETRIEVAL_CACHE_SIZE, ttl=RETRIEVAL_CACHE_TTL),
+    key=lambda corpus_config, query_text: (
+        corpus_config['corpus_name'], hashlib.sha256(query_text.encode("utf-8")).hexdigest()
+    ),
+    lock=threading.Lock(),
+)
+def query_corpus(corpus_config, query_text):
+    from vertexai.preview import rag
     rag_name = corpus_config['corpus_name']
     response = rag.retrieval_query(
         rag_resources=[
@@ -107,15 +193,18 @@ def query_corpus(corpus_config, credentials_path, query_text):
     )
     return response 
 
-def enhanced_query_corpus(corpus_config, credentials_path, known_info, myquestion):
-
+# The tool and model only depend on the corpus, build them once and reuse them
+@functools.lru_cache(maxsize=8)
+def get_rag_model(corpus_name):
+    from vertexai.preview import rag
+    from vertexai.preview.generative_models import GenerativeModel, Tool
     # Create a RAG retrieval tool
     rag_retrieval_tool = Tool.from_retrieval(
         retrieval=rag.Retrieval(
             source=rag.VertexRagStore(
                 rag_resources=[
                     rag.RagResource(
-                        rag_corpus=corpus_config['corpus_name'],  # Currently only 1 corpus is allowed.
+                        rag_corpus=corpus_name,  # Currently only 1 corpus is allowed.
                 )
             ],
             similarity_top_k=3,  # Optional
@@ -124,146 +213,149 @@ def enhanced_query_corpus(corpus_config, credentials_path, known_info, myquestio
         )
     )
 
-    #Set System
-    system_list = [ 
-        "You are an expert assistance extracting information from context provided.",
-        "Answer the question based on the context. Be concise and do not hallucinate.",
-        "Respond with the information you have in polite and professional manner.",
-        "If you do not have the information just say so and start the reply with [NONE].",
-        "Any query for Member ID or Member Number should use Brand_Member_ID as context but refer to it as Member ID.",
-        "Responsed in markdown format to make it easy to read.",
-    ]
-    # Set prompt
-    prompt = f"""
-        Context:  Additional data {known_info}
-        Question:  
-        {myquestion}
-        Answer: '
-    """
-    content = [ prompt ]
-
-    #Make system_list + prompt a single string this is missing the RAG context
-    full_prompt = ' '.join(system_list) + prompt
-
     # Create a gemini-pro model instance
         #model_name="gemini-1.5-flash-001", tools=[rag_retrieval_tool]
-    rag_model = GenerativeModel(
+    return GenerativeModel(
         model_name="gemini-1.5-pro-001", tools=[rag_retrieval_tool], 
-        system_instruction=system_list,
+        system_instruction=list(SYSTEM_LIST),
     )
 
-    # Generate response
-    response = rag_model.generate_content(content)
-    #return prompt and response
-    return full_prompt, response
+def enhanced_query_corpus(corpus_config, known_info, myquestion, stream=False):
+    # With stream=True the response is an iterator of partial responses, see stream_reply_text
 
-def get_rag_prompt(corpus_config_path, credentials_path, config, contact_id):
-    # Load the corpus configuration
-    corpus_config = load_json_config(corpus_config_path)
+    # Set prompt
+    prompt = ENHANCED_PROMPT_TEMPLATE.substitute(known_info=format_known_info(known_info), question=myquestion)
+    content = [ prompt ]
 
-    #Initialize Vertex AI API
-    initialize_vertex_ai(corpus_config['project_id'], corpus_config['location'], credentials_path)
+    #Make SYSTEM_LIST + prompt a single string this is missing the RAG context
+    full_prompt = SYSTEM_PREFIX + prompt
 
-    # Get the record from the database
-    submission_info = fetch_submission_details(config, contact_id)
-    myquestion = submission_info['Contact_Question']
+    rag_model = get_rag_model(corpus_config['corpus_name'])
 
-    # Get additional information from the database
-    known_info = get_member_data(config, submission_info)
+    # Generate response
+    response = rag_model.generate_content(content, stream=stream)
+    #return prompt and response
+    return full_prompt, response
 
-    # Query the corpus
-    answer = query_corpus(corpus_config, credentials_path, submission_info['Contact_Question'])
-    rag_reply = ""
+def get_rag_context(corpus_config, query_text):
+    """
+    Returns the text of the best matching corpus context for the query, or "" if none matched.
+    """
+    answer = query_corpus(corpus_config, query_text)
     contexts_list = answer.contexts.contexts
     if contexts_list:
-        rag_reply = contexts_list[0].text  # Get the first context
+        return contexts_list[0].text  # Get the first context
+    return ""
+
+def get_rag_prompt(corpus_config, config, contact_id, question=None):
+    # corpus_config is the handle from load_rag_handle, Vertex AI is already initialized
+    # Returns (full_prompt, reply), reply is NO_INFO_REPLY when there is nothing to send to an LLM, otherwise None
+
+    if question is None:
+        # Get the record and additional member information from the database
+        submission_info, known_info = fetch_submission_and_member(config, contact_id)
+        myquestion = submission_info['Contact_Question']
+
+        # Query the corpus
+        rag_reply = get_rag_context(corpus_config, myquestion)
     else:
-        rag_reply = ""
-
-    #Set System
-    system_list = [ 
-        "You are an expert assistance extracting information from context provided.",
-        "Answer the question based on the context. Be concise and do not hallucinate.",
-        "Respond with the information you have in polite and professional manner.",
-        "If you do not have the information just say so and start the reply with [NONE].",
-        "Any query for Member ID or Member Number should use Brand_Member_ID as context but refer to it as Member ID.",
-        "Responsed in markdown format to make it easy to read.",
-    ]
-    # Set prompt
-    prompt = f"""
-        Context: {rag_reply} with Additional data {known_info}
-        Question:  
-        {myquestion}
-        Answer: '
-    """
+        # The question is already known, so query the corpus while the database lookup runs
+        myquestion = question
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            rag_future = executor.submit(get_rag_context, corpus_config, myquestion)
+            submission_info, known_info = fetch_submission_and_member(config, contact_id)
+            rag_reply = rag_future.result()
 
-    #Make system_list + prompt a single string this is missing the RAG context
-    full_prompt = ' '.join(system_list) + prompt
+    # Set prompt
+    prompt = RAG_PROMPT_TEMPLATE.substitute(rag_reply=rag_reply, known_info=format_known_info(known_info), question=myquestion)
 
-    return full_prompt
+    #Make SYSTEM_LIST + prompt a single string this is missing the RAG context
+    full_prompt = SYSTEM_PREFIX + prompt
 
-def get_rag_response(corpus_config_path, credentials_path, config, contact_id):
-    # Load the corpus configuration
-    corpus_config = load_json_config(corpus_config_path)
+    if not rag_reply and not known_info:
+        return full_prompt, NO_INFO_REPLY
+    return full_prompt, None
 
-    #Initialize Vertex AI API
-    initialize_vertex_ai(corpus_config['project_id'], corpus_config['location'], credentials_path)
+def get_rag_response(corpus_config, config, contact_id, on_token=None):
+    # corpus_config is the handle from load_rag_handle, Vertex AI is already initialized
+    # on_token is called with the reply so far as Gemini streams it, throttled by collect_stream
 
-    # Get the record from the database
-    submission_info = fetch_submission_details(config, contact_id)
+    # Get the record and additional member information from the database
+    submission_info, known_info = fetch_submission_and_member(config, contact_id)
+    myquestion = submission_info['Contact_Question']
+    # Recorded as the prompt when the reply does not come from Gemini, same as enhanced_query_corpus builds
+    prompt = SYSTEM_PREFIX + ENHANCED_PROMPT_TEMPLATE.substitute(known_info=format_known_info(known_info), question=myquestion)
 
-    # Get additional information from the database
-    known_info = get_member_data(config, submission_info)
+    # Paraphrases of an already answered question for the same member data skip Gemini,
+    # only the reply is reused, the earlier question stays out of this submission's prompt.
+    # The cache fails open, an embedding or cache file error only costs the Gemini call it would have saved
+    embedding, cached_reply = None, None
+    try:
+        embedding = embed_question(myquestion)
+        cached_reply = lookup_answer(embedding, known_info)
+    except Exception as e:
+        log.warning("Semantic cache lookup failed: %s", e)
+    if cached_reply:
+        if on_token:
+            on_token(cached_reply)
+        return prompt, cached_reply
+
+    # Gemini retrieves from the corpus itself, so this extra retrieval only runs on a cache miss
+    # with no member data, query_corpus caches it for repeats
+    if not known_info and not get_rag_context(corpus_config, myquestion):
+        if on_token:
+            on_token(NO_INFO_REPLY)
+        return prompt, NO_INFO_REPLY
 
     # Query the corpus
-    prompt, answer = enhanced_query_corpus(corpus_config, credentials_path, known_info, submission_info['Contact_Question'])
-    reply = ""
-    #return answer.content.parts.text
-    for candidate in answer.candidates:
-        print(candidate)
-        if candidate.content.role == "model":
-            for part in candidate.content.parts:
-                reply = part.text
-        break  # Assuming you only need the first match
-
+    prompt, responses = enhanced_query_corpus(corpus_config, known_info, myquestion, stream=True)
+    reply = collect_stream(stream_reply_text(responses), on_token)
+
+    if reply and embedding is not None:
+        try:
+            store_answer(embedding, myquestion, known_info, reply)
+        except Exception as e:
+            log.warning("Semantic cache store failed: %s", e)
     return prompt, reply
 
+def stream_reply_text(responses):
+    """
+    Yields the model text of each partial response from enhanced_query_corpus(..., stream=True).
+    Front ends can iterate this directly, e.g. to forward it as Server-Sent Events.
+    """
+    for response in responses:
+        yield ''.join(part.text for candidate in response.candidates if candidate.content.role == "model" for part in candidate.content.parts)
+
 def main():
     parser = argparse.ArgumentParser(description='Query a corpus using RAG from Vertex AI.')
     parser.add_argument('-i', '--contact_id', required=True, help='Contact_ID from contact_queue table.')
     args = parser.parse_args()
+    # Debug output is off unless LOG_LEVEL=DEBUG is set in the environment
+    logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper())
 
     #Load the config.json with db setttings
     app_config = load_json_config("config.json")
-    # Load the corpus configuration
-    corpus_config = load_json_config("vsp-genai_corpus_config.json")
     #Set path to credentials (current directory) + /key.json
     credentials = os.path.join(os.getcwd(), 'key.json')
-
-    # Initialize Vertex AI API
-    initialize_vertex_ai(corpus_config['project_id'], corpus_config['location'], credentials)
-
-    # Get the record from the database
-    submission_info = fetch_submission_details(app_config, args.contact_id)
-
-    # Get additional information from the database
-    known_info = get_member_data(app_config, submission_info)
+    # Initialize Vertex AI API while the database is queried, neither depends on the other
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # Load the corpus configuration and initialize Vertex AI API
+        handle_future = executor.submit(load_rag_handle, "vsp-genai_corpus_config.json", credentials)
+        # Get the record and additional member information from the database
+        submission_info, known_info = fetch_submission_and_member(app_config, args.contact_id)
+        corpus_config = handle_future.result()
 
     # Query the corpus
-    #results = query_corpus(corpus_config, args.credentials, args.query)
-    #results = query_corpus(corpus_config, credentials, submission_info['Contact_Question'])
+    #results = query_corpus(corpus_config, args.query)
+    #results = query_corpus(corpus_config, submission_info['Contact_Question'])
     #contexts_list = results.contexts.contexts
     #prompt_context = ""
     #prompt_context = contexts_list[0].text  # Get the first context
-    prompt, answer = enhanced_query_corpus(corpus_config, credentials, known_info, submission_info['Contact_Question'])
-    for candidate in answer.candidates:
-        if candidate.content.role == "model":
-            for part in candidate.content.parts:
-                print(part.text)
-        break  # Assuming you only need the first match
-
-    print(prompt)
-    print(answer)
+    prompt, answer = enhanced_query_corpus(corpus_config, known_info, submission_info['Contact_Question'])
+    print(''.join(part.text for candidate in answer.candidates if candidate.content.role == "model" for part in candidate.content.parts))
+
+    log.debug("Prompt: %s", prompt)
+    log.debug("Raw response: %s", answer)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
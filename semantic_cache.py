@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+
+# Script: semantic_cache.py
+# Description: Semantic cache for RAG answers, used by google_rag_query.py.
+# Questions are embedded with Vertex AI and looked up in an hnswlib index, a close enough
+# match for the same member data returns the stored answer instead of calling Gemini again.
+
+# Date: 2026-10-15
+# Version: 1.0
+# License: MIT
+
+import os, json, hashlib, threading
+import atexit
+import functools
+import logging
+import pickle
+import time
+from collections import OrderedDict
+from contextlib import closing
+# hnswlib and numpy are imported where they are used, so importing this module stays cheap
+
+from contact_utils import connect_to_mysql
+
+# Embedding model and its output size
+EMBEDDING_MODEL = "text-embedding-004"
+EMBEDDING_DIM = 768
+# Most texts the embedding API accepts in one get_embeddings call
+EMBEDDING_BATCH_SIZE = 250
+# Number of question embeddings kept in memory, least recently used are dropped first
+EMBEDDING_MEMO_SIZE = 2048
+# Cosine similarity a cached question needs to count as the same question
+SIMILARITY_THRESHOLD = 0.92
+# Number of neighbours checked per lookup
+LOOKUP_K = 5
+# Most answers kept, a full cache drops expired and least recently used answers
+MAX_ENTRIES = 10000
+# Fraction of MAX_ENTRIES left after an eviction, so the index is rebuilt only once in a while
+KEEP_FRACTION = 0.9
+# Seconds an answer is served, the same as the corpus retrieval cache in google_rag_query
+ENTRY_TTL = 24 * 3600
+# Directory the entries are saved to, the index is rebuilt from their embeddings on load
+CACHE_DIR = "semantic_cache"
+CACHE_FILE = "cache.pkl"
+# Seconds between saves of new answers, the cache is also saved at exit
+SAVE_INTERVAL = 60
+
+log = logging.getLogger(__name__)
+
+# Lazily loaded index and the entries stored alongside it, label i is _ENTRIES[i]
+# and _LAST_USED[i] is when it was last stored or served
+_INDEX = None
+_ENTRIES = []
+_LAST_USED = []
+_LOCK = threading.Lock()
+# Held for a whole save so snapshots reach the disk in the order they were taken
+_SAVE_LOCK = threading.Lock()
+_DIRTY = False
+_LAST_SAVE = 0.0
+# Exact repeats of a question are answered from memory without calling the embedding API
+_EMBEDDINGS = OrderedDict()
+_EMBEDDINGS_LOCK = threading.Lock()
+
+@functools.lru_cache(maxsize=1)
+def get_embedding_model():
+    # Vertex AI must already be initialized, see google_rag_query.load_rag_handle
+    from vertexai.language_models import TextEmbeddingModel
+    return TextEmbeddingModel.from_pretrained(EMBEDDING_MODEL)
+
+def build_index(entries):
+    """
+    Returns a new hnswlib index of the entries' embeddings with room for MAX_ENTRIES, label i is entries[i].
+    """
+    import hnswlib
+    import numpy as np
+
+    index = hnswlib.Index(space='cosine', dim=EMBEDDING_DIM)
+    index.init_index(max_elements=MAX_ENTRIES)
+    if entries:
+        index.add_items(np.stack([entry["embedding"] for entry in entries]), list(range(len(entries))))
+    return index
+
+def embed_question(question):
+    """
+    Returns the embedding of a question as a float32 numpy array.
+    The question is lowercased and its whitespace collapsed first so trivial variations share a cache entry.
+    """
+    return embed_questions([question])[0]
+
+def embed_questions(questions):
+    """
+    Returns the embeddings of a list of questions, normalized as in embed_question.
+    Questions not already in memory are sent to the embedding API EMBEDDING_BATCH_SIZE at a time.
+
+    Args:
+        questions (list): The question texts.
+
+    Returns:
+        list: A float32 numpy array per question, in the same order.
+    """
+    import numpy as np
+
+    normalized = [" ".join(question.lower().split()) for question in questions]
+    with _EMBEDDINGS_LOCK:
+        embedded = {text: _EMBEDDINGS[text] for text in normalized if text in _EMBEDDINGS}
+    missing = list(dict.fromkeys(text for text in normalized if text not in embedded))
+    for start in range(0, len(missing), EMBEDDING_BATCH_SIZE):
+        batch = missing[start:start + EMBEDDING_BATCH_SIZE]
+        for text, embedding in zip(batch, get_embedding_model().get_embeddings(batch)):
+            embedded[text] = np.asarray(embedding.values, dtype=np.float32)
+    with _EMBEDDINGS_LOCK:
+        for text in normalized:
+            _EMBEDDINGS[text] = embedded[text]
+            _EMBEDDINGS.move_to_end(text)
+        while len(_EMBEDDINGS) > EMBEDDING_MEMO_SIZE:
+            _EMBEDDINGS.popitem(last=False)
+    return [embedded[text] for text in normalized]
+
+def evict_entries():
+    """
+    Drops expired answers, then the least recently used ones until KEEP_FRACTION of MAX_ENTRIES remain,
+    and rebuilds the index from what is left. Must be called with _LOCK held.
+    """
+    global _INDEX, _ENTRIES, _LAST_USED
+    now = time.time()
+    live = [i for i, entry in enumerate(_ENTRIES) if is_fresh(entry, now)]
+    live.sort(key=lambda i: _LAST_USED[i], reverse=True)
+    kept = sorted(live[:int(MAX_ENTRIES * KEEP_FRACTION)])
+    _ENTRIES = [_ENTRIES[i] for i in kept]
+    _LAST_USED = [_LAST_USED[i] for i in kept]
+    _INDEX = build_index(_ENTRIES)
+
+def hash_known_info(known_info):
+    """
+    Returns a stable hash of the member data, answers are only reused for the same member data.
+    """
+    known_json = json.dumps(known_info, sort_keys=True, default=str)
+    return hashlib.sha256(known_json.encode("utf-8")).hexdigest()
+
+def is_fresh(entry, now):
+    """
+    Returns True while an entry is younger than ENTRY_TTL, older answers may predate corpus changes.
+    """
+    return now - entry["created"] < ENTRY_TTL
+
+def load_index():
+    """
+    Returns the hnswlib index, loading the saved entries from CACHE_DIR on first use.
+    Expired entries are dropped, an unreadable save is logged and the cache starts empty.
+    Must be called with _LOCK held.
+    """
+    global _INDEX, _ENTRIES, _LAST_USED
+    if _INDEX is None:
+        _ENTRIES, _LAST_USED = [], []
+        cache_path = os.path.join(CACHE_DIR, CACHE_FILE)
+        if os.path.isfile(cache_path):
+            try:
+                with open(cache_path, 'rb') as file:
+                    entries, last_used = pickle.load(file)
+                now = time.time()
+                kept = [i for i, entry in enumerate(entries) if is_fresh(entry, now)]
+                _ENTRIES = [entries[i] for i in kept]
+                _LAST_USED = [last_used[i] for i in kept]
+            except Exception as e:
+                log.warning("Semantic cache could not be loaded, starting empty: %s", e)
+                _ENTRIES, _LAST_USED = [], []
+        _INDEX = build_index(_ENTRIES)
+    return _INDEX
+
+def lookup_answer(embedding, known_info):
+    """
+    Look up a cached answer for a question embedding, expired answers count as misses.
+    Contacts without a member record all have known_info {} and share answers with each other,
+    this is intended since those answers are drawn from the corpus alone.
+
+    Args:
+        embedding (numpy.ndarray): The question embedding from embed_question.
+        known_info (dict): The member data the answer was generated with.
+
+    Returns:
+        str or None: The cached reply, or None on a miss.
+    """
+    known_info_hash = hash_known_info(known_info)
+    now = time.time()
+    with _LOCK:
+        index = load_index()
+        count = index.get_current_count()
+        if count == 0:
+            return None
+        labels, distances = index.knn_query(embedding, k=min(LOOKUP_K, count))
+        # cosine distance is 1 - similarity, neighbours come back closest first
+        for label, distance in zip(labels[0], distances[0]):
+            if distance > 1 - SIMILARITY_THRESHOLD:
+                break
+            entry = _ENTRIES[label]
+            if entry["known_info_hash"] == known_info_hash and is_fresh(entry, now):
+                _LAST_USED[label] = now
+                return entry["reply"]
+    return None
+
+def save_cache():
+    """
+    Save the entries to CACHE_DIR if answers were added since the last save.
+    Only the entry lists are copied under _LOCK, entries are never modified once stored, so pickling
+    and the file write happen after the lock is released. The file is swapped in with os.replace
+    so a crash mid-write leaves the previous save intact.
+
+    Returns:
+        None
+    """
+    global _DIRTY, _LAST_SAVE
+    with _SAVE_LOCK:
+        with _LOCK:
+            if _INDEX is None or not _DIRTY:
+                return
+            entries, last_used = list(_ENTRIES), list(_LAST_USED)
+            _DIRTY = False
+            _LAST_SAVE = time.monotonic()
+        data = pickle.dumps((entries, last_used))
+        cache_path = os.path.join(CACHE_DIR, CACHE_FILE)
+        tmp_path = cache_path + ".tmp"
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            with open(tmp_path, 'wb') as file:
+                file.write(data)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            log.warning("Saving the semantic cache failed: %s", e)
+            with _LOCK:
+                _DIRTY = True
+
+def store_answer(embedding, question, known_info, reply):
+    """
+    Add an answer to the cache, it is saved to CACHE_DIR in the background every SAVE_INTERVAL seconds.
+    A full cache is trimmed by evict_entries first.
+
+    Args:
+        embedding (numpy.ndarray): The question embedding from embed_question.
+        question (str): The question text.
+        known_info (dict): The member data the answer was generated with.
+        reply (str): The model reply.
+
+    Returns:
+        None
+    """
+    global _DIRTY
+    with _LOCK:
+        load_index()
+        if len(_ENTRIES) >= MAX_ENTRIES:
+            evict_entries()
+        now = time.time()
+        _INDEX.add_items(embedding.reshape(1, -1), [len(_ENTRIES)])
+        _ENTRIES.append({
+            "question": question,
+            "known_info_hash": hash_known_info(known_info),
+            "reply": reply,
+            "embedding": embedding,
+            "created": now,
+        })
+        _LAST_USED.append(now)
+        _DIRTY = True
+        save_due = time.monotonic() - _LAST_SAVE >= SAVE_INTERVAL
+    if save_due:
+        threading.Thread(target=save_cache, daemon=True).start()
+
+def warm_embeddings(config, limit=EMBEDDING_MEMO_SIZE):
+    """
+    Embed the most recent questions in contact_queue so repeats of them skip the embedding API.
+
+    Args:
+        config (dict): The database configuration from config.json.
+        limit (int): Number of recent questions to embed, at most EMBEDDING_MEMO_SIZE are kept.
+
+    Returns:
+        int: The number of questions embedded.
+    """
+    with closing(connect_to_mysql(config)) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT Contact_Question FROM contact_queue WHERE Contact_Question IS NOT NULL "
+                "ORDER BY Contact_ID DESC LIMIT %s", (limit,)
+            )
+            # oldest first so the most recent questions are the last dropped from memory
+            questions = [row[0] for row in reversed(cursor.fetchall())]
+    embed_questions(questions)
+    return len(questions)
+
+atexit.register(save_cache)
@@ -41,11 +41,20 @@ CREATE TABLE `contact_queue` (
   `Processed_Date` timestamp NULL DEFAULT NULL,
   `Status` varchar(10) DEFAULT 'Open',
   `Payload` text DEFAULT NULL,
+  `LLM_Type` varchar(16) GENERATED ALWAYS AS (JSON_UNQUOTE(JSON_EXTRACT(`Payload`, '$.llm'))) STORED,
+  `Trace_ID` varchar(64) GENERATED ALWAYS AS (JSON_UNQUOTE(JSON_EXTRACT(`Payload`, '$.trace_id'))) STORED,
   PRIMARY KEY (`Contact_ID`),
   KEY `Contact_Email` (`Contact_Email`),
   KEY `Contact_Lname` (`Contact_Lname`),
   KEY `Contact_Fname` (`Contact_Fname`),
   KEY `Creation_Date` (`Creation_Date`),
-  KEY `Status` (`Status`)
+  KEY `Status` (`Status`),
+  KEY `LLM_Type` (`LLM_Type`)
 ) ENGINE=InnoDB AUTO_INCREMENT=8 DEFAULT CHARSET=utf8 COLLATE=utf8_general_ci;
 
+-- Upgrade an existing contact_queue with the generated Payload columns
+-- ALTER TABLE `contact_queue`
+--   ADD COLUMN `LLM_Type` varchar(16) GENERATED ALWAYS AS (JSON_UNQUOTE(JSON_EXTRACT(`Payload`, '$.llm'))) STORED,
+--   ADD COLUMN `Trace_ID` varchar(64) GENERATED ALWAYS AS (JSON_UNQUOTE(JSON_EXTRACT(`Payload`, '$.trace_id'))) STORED,
+--   ADD KEY `LLM_Type` (`LLM_Type`);
+
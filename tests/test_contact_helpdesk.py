@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+# Script: test_contact_helpdesk.py
+# Description: Unit tests for the contact_queue UPDATE builders in contact_helpdesk.py, the database is stubbed.
+# Run from the repository root with: python -m unittest discover tests
+
+import unittest
+from unittest import mock
+
+import contact_helpdesk
+
+
+class PayloadJsonSetTest(unittest.TestCase):
+
+    def test_each_key_is_a_path_and_json_value(self):
+        sql, values = contact_helpdesk.payload_json_set({"llm": "openai", "trace_id": "t1"})
+        self.assertEqual(
+            sql, "JSON_SET(COALESCE(Payload, '{}'), %s, CAST(%s AS JSON), %s, CAST(%s AS JSON))"
+        )
+        self.assertEqual(values, ["$.llm", '"openai"', "$.trace_id", '"t1"'])
+
+
+class UpdateSubmissionMultiTest(unittest.TestCase):
+
+    def update(self, fields, payload_updates=None):
+        """Runs update_submission_multi on a stub connection and returns the executed query and values."""
+        connection = mock.MagicMock()
+        cursor = connection.cursor.return_value.__enter__.return_value
+        with mock.patch.object(contact_helpdesk, "connect_to_mysql", return_value=connection), \
+                mock.patch.object(contact_helpdesk, "fetch_waiting_submissions") as fetch_waiting:
+            contact_helpdesk.update_submission_multi({}, 7, fields, payload_updates)
+        connection.commit.assert_called_once_with()
+        fetch_waiting.clear.assert_called_once_with()
+        cursor.execute.assert_called_once()
+        return cursor.execute.call_args.args
+
+    def test_fields_only(self):
+        query, values = self.update({"Final_Response": "reply", "Evaluation": 4})
+        self.assertEqual(
+            query, "UPDATE contact_queue SET Final_Response = %s, Evaluation = %s WHERE Contact_ID = %s"
+        )
+        self.assertEqual(values, ("reply", 4, 7))
+
+    def test_fields_and_payload(self):
+        query, values = self.update(
+            {"Contact_Response": "reply", "Status": "Processed"}, {"llm": "openai", "trace_id": "t1"}
+        )
+        self.assertEqual(
+            query,
+            "UPDATE contact_queue SET Contact_Response = %s, Status = %s, "
+            "Payload = JSON_SET(COALESCE(Payload, '{}'), %s, CAST(%s AS JSON), %s, CAST(%s AS JSON)) "
+            "WHERE Contact_ID = %s",
+        )
+        self.assertEqual(values, ("reply", "Processed", "$.llm", '"openai"', "$.trace_id", '"t1"', 7))
+
+    def test_none_payload_values_are_skipped(self):
+        query, values = self.update({"Status": "Processed"}, {"llm": "openai", "trace_id": None})
+        self.assertEqual(
+            query,
+            "UPDATE contact_queue SET Status = %s, "
+            "Payload = JSON_SET(COALESCE(Payload, '{}'), %s, CAST(%s AS JSON)) WHERE Contact_ID = %s",
+        )
+        self.assertEqual(values, ("Processed", "$.llm", '"openai"', 7))
+
+    def test_all_none_payload_leaves_payload_alone(self):
+        query, values = self.update({"Status": "Processed"}, {"trace_id": None})
+        self.assertEqual(query, "UPDATE contact_queue SET Status = %s WHERE Contact_ID = %s")
+        self.assertEqual(values, ("Processed", 7))
+
+    def test_none_field_values_are_bound_as_null(self):
+        query, values = self.update({"Contact_Response": None})
+        self.assertEqual(query, "UPDATE contact_queue SET Contact_Response = %s WHERE Contact_ID = %s")
+        self.assertEqual(values, (None, 7))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+# Script: test_google_rag_query.py
+# Description: Unit tests for the MySQL lookups in google_rag_query.py, connections are stubbed.
+# Run from the repository root with: python -m unittest discover tests
+
+import unittest
+from unittest import mock
+
+import mysql.connector
+
+import google_rag_query
+
+
+def fake_connection(row=None, error=None, close_error=None):
+    """
+    Returns a stand in pooled connection whose cursor returns row or raises error on execute.
+    close_error is raised by close(), like a session reset on a dropped connection.
+    """
+    cursor = mock.MagicMock()
+    cursor.fetchone.return_value = row
+    if error is not None:
+        cursor.execute.side_effect = error
+    connection = mock.MagicMock()
+    connection.cursor.return_value.__enter__.return_value = cursor
+    if close_error is not None:
+        connection.close.side_effect = close_error
+    return connection
+
+
+class FetchOneTest(unittest.TestCase):
+
+    def fetch(self, *connections):
+        with mock.patch.object(google_rag_query, "connect_to_mysql", side_effect=connections) as connect:
+            result = google_rag_query.fetch_one({}, "SELECT 1", ())
+        return result, connect.call_count
+
+    def test_returns_the_first_row(self):
+        row = {"Contact_Question": "q"}
+        self.assertEqual(self.fetch(fake_connection(row)), (row, 1))
+
+    def test_lost_connection_is_retried_once(self):
+        row = {"Contact_Question": "q"}
+        for errno in (2006, 2013):
+            with self.subTest(errno=errno):
+                lost = fake_connection(error=mysql.connector.Error(msg="lost", errno=errno))
+                self.assertEqual(self.fetch(lost, fake_connection(row)), (row, 2))
+
+    def test_failing_close_does_not_stop_the_retry(self):
+        row = {"Contact_Question": "q"}
+        lost = fake_connection(error=mysql.connector.Error(msg="lost", errno=2013),
+                               close_error=mysql.connector.Error(msg="reset failed", errno=2055))
+        self.assertEqual(self.fetch(lost, fake_connection(row)), (row, 2))
+        lost.close.assert_called_once_with()
+
+    def test_failing_close_keeps_the_original_error(self):
+        broken = fake_connection(error=mysql.connector.Error(msg="no such table", errno=1146),
+                                 close_error=mysql.connector.Error(msg="reset failed", errno=2055))
+        with self.assertRaises(mysql.connector.Error) as raised:
+            self.fetch(broken)
+        self.assertEqual(raised.exception.errno, 1146)
+
+    def test_lost_extended_is_retried(self):
+        row = {"Contact_Question": "q"}
+        lost = fake_connection(error=mysql.connector.Error(msg="lost", errno=2055))
+        self.assertEqual(self.fetch(lost, fake_connection(row)), (row, 2))
+
+    def test_second_lost_connection_is_raised(self):
+        lost = mysql.connector.Error(msg="lost", errno=2013)
+        with self.assertRaises(mysql.connector.Error):
+            self.fetch(fake_connection(error=lost), fake_connection(error=lost))
+
+    def test_other_errors_are_raised_without_retry(self):
+        error = mysql.connector.Error(msg="no such table", errno=1146)
+        with mock.patch.object(google_rag_query, "connect_to_mysql",
+                               side_effect=[fake_connection(error=error)]) as connect:
+            with self.assertRaises(mysql.connector.Error):
+                google_rag_query.fetch_one({}, "SELECT 1", ())
+        self.assertEqual(connect.call_count, 1)
+
+
+class FetchSubmissionAndMemberTest(unittest.TestCase):
+
+    def lookup(self, row=None, error=None):
+        with mock.patch.object(google_rag_query, "connect_to_mysql",
+                               return_value=fake_connection(row, error)):
+            return google_rag_query.fetch_submission_and_member({}, 7)
+
+    def test_splits_submission_and_member_columns(self):
+        row = {"Contact_Question": "q", "Member_Found": 1, "Brand_Member_ID": "B1"}
+        self.assertEqual(self.lookup(row), ({"Contact_Question": "q"}, {"Brand_Member_ID": "B1"}))
+
+    def test_no_member_gives_empty_known_info(self):
+        row = {"Contact_Question": "q", "Member_Found": 0, "Brand_Member_ID": None}
+        self.assertEqual(self.lookup(row), ({"Contact_Question": "q"}, {}))
+
+    def test_database_error_gives_empty_results(self):
+        error = mysql.connector.Error(msg="no such table", errno=1146)
+        self.assertEqual(self.lookup(error=error), ({}, {}))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+# Script: test_semantic_cache.py
+# Description: Unit tests for semantic_cache.py, the Vertex AI embedding model is stubbed.
+# Run from the repository root with: python -m unittest discover tests
+
+import os
+import tempfile
+import time
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import numpy as np
+
+import semantic_cache
+
+
+class FakeEmbeddingModel:
+    """Stands in for TextEmbeddingModel, records each get_embeddings batch."""
+
+    def __init__(self):
+        self.batches = []
+
+    def get_embeddings(self, texts):
+        self.batches.append(list(texts))
+        return [SimpleNamespace(values=[float(len(text))] * 4) for text in texts]
+
+
+def unit_vector(position):
+    vector = np.zeros(semantic_cache.EMBEDDING_DIM, dtype=np.float32)
+    vector[position] = 1.0
+    return vector
+
+
+class SemanticCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        patches = [
+            mock.patch.object(semantic_cache, "CACHE_DIR", cache_dir.name),
+            mock.patch.object(semantic_cache, "_INDEX", None),
+            mock.patch.object(semantic_cache, "_ENTRIES", []),
+            mock.patch.object(semantic_cache, "_LAST_USED", []),
+            mock.patch.object(semantic_cache, "_EMBEDDINGS", semantic_cache.OrderedDict()),
+            mock.patch.object(semantic_cache, "_DIRTY", False),
+            # keep store_answer from starting a background save during a test
+            mock.patch.object(semantic_cache, "_LAST_SAVE", time.monotonic()),
+            mock.patch.object(semantic_cache, "SAVE_INTERVAL", 3600),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.model = FakeEmbeddingModel()
+        patch = mock.patch.object(semantic_cache, "get_embedding_model", return_value=self.model)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+
+class EmbedQuestionsTest(SemanticCacheTestCase):
+
+    def test_misses_are_sent_in_batches(self):
+        questions = [f"question {i}" for i in range(5)]
+        with mock.patch.object(semantic_cache, "EMBEDDING_BATCH_SIZE", 2):
+            embeddings = semantic_cache.embed_questions(questions)
+        self.assertEqual([len(batch) for batch in self.model.batches], [2, 2, 1])
+        self.assertEqual(len(embeddings), 5)
+        self.assertEqual(embeddings[0].dtype, np.float32)
+
+    def test_normalized_duplicates_are_embedded_once(self):
+        semantic_cache.embed_questions(["Where is my card?", "  where IS my   card? "])
+        self.assertEqual(self.model.batches, [["where is my card?"]])
+
+    def test_memo_skips_the_api_for_repeats(self):
+        semantic_cache.embed_question("What is my copay?")
+        semantic_cache.embed_question("what is my copay?")
+        self.assertEqual(len(self.model.batches), 1)
+
+    def test_memo_evicts_least_recently_used(self):
+        with mock.patch.object(semantic_cache, "EMBEDDING_MEMO_SIZE", 2):
+            semantic_cache.embed_questions(["a", "b"])
+            semantic_cache.embed_question("a")
+            semantic_cache.embed_question("c")
+            self.assertEqual(list(semantic_cache._EMBEDDINGS), ["a", "c"])
+            semantic_cache.embed_question("b")
+        self.assertEqual(self.model.batches, [["a", "b"], ["c"], ["b"]])
+
+
+class LookupAnswerTest(SemanticCacheTestCase):
+
+    def test_hit_returns_the_stored_reply(self):
+        semantic_cache.store_answer(unit_vector(0), "q", {"Brand_Member_ID": "1"}, "reply")
+        self.assertEqual(semantic_cache.lookup_answer(unit_vector(0), {"Brand_Member_ID": "1"}), "reply")
+
+    def test_different_known_info_misses(self):
+        semantic_cache.store_answer(unit_vector(0), "q", {"Brand_Member_ID": "1"}, "reply")
+        self.assertIsNone(semantic_cache.lookup_answer(unit_vector(0), {"Brand_Member_ID": "2"}))
+
+    def test_below_threshold_misses(self):
+        semantic_cache.store_answer(unit_vector(0), "q", {}, "reply")
+        # cosine similarity 0.8 against the stored vector
+        query = 0.8 * unit_vector(0) + 0.6 * unit_vector(1)
+        self.assertIsNone(semantic_cache.lookup_answer(query, {}))
+
+    def test_above_threshold_hits(self):
+        semantic_cache.store_answer(unit_vector(0), "q", {}, "reply")
+        # cosine similarity 0.96 against the stored vector
+        query = 0.96 * unit_vector(0) + 0.28 * unit_vector(1)
+        self.assertEqual(semantic_cache.lookup_answer(query, {}), "reply")
+
+    def test_empty_cache_misses(self):
+        self.assertIsNone(semantic_cache.lookup_answer(unit_vector(0), {}))
+
+    def test_saved_cache_is_reloaded(self):
+        semantic_cache.store_answer(unit_vector(0), "q", {}, "reply")
+        semantic_cache.save_cache()
+        semantic_cache._INDEX = None
+        semantic_cache._ENTRIES = []
+        semantic_cache._LAST_USED = []
+        self.assertEqual(semantic_cache.lookup_answer(unit_vector(0), {}), "reply")
+
+    def test_expired_answer_misses(self):
+        semantic_cache.store_answer(unit_vector(0), "q", {}, "reply")
+        semantic_cache._ENTRIES[0]["created"] -= semantic_cache.ENTRY_TTL + 1
+        self.assertIsNone(semantic_cache.lookup_answer(unit_vector(0), {}))
+
+    def test_expired_answers_are_not_reloaded(self):
+        semantic_cache.store_answer(unit_vector(0), "old", {}, "old reply")
+        semantic_cache.store_answer(unit_vector(1), "new", {}, "new reply")
+        semantic_cache._ENTRIES[0]["created"] -= semantic_cache.ENTRY_TTL + 1
+        semantic_cache.save_cache()
+        semantic_cache._INDEX = None
+        semantic_cache._ENTRIES = []
+        semantic_cache._LAST_USED = []
+        self.assertEqual(semantic_cache.lookup_answer(unit_vector(1), {}), "new reply")
+        self.assertEqual([entry["question"] for entry in semantic_cache._ENTRIES], ["new"])
+
+    def test_full_cache_evicts_least_recently_used(self):
+        with mock.patch.object(semantic_cache, "MAX_ENTRIES", 4), \
+                mock.patch.object(semantic_cache, "KEEP_FRACTION", 0.5):
+            for position in range(4):
+                semantic_cache.store_answer(unit_vector(position), f"q{position}", {}, f"reply {position}")
+            semantic_cache._LAST_USED[:] = [1.0, 4.0, 2.0, 3.0]
+            semantic_cache.store_answer(unit_vector(4), "q4", {}, "reply 4")
+            self.assertEqual([entry["question"] for entry in semantic_cache._ENTRIES], ["q1", "q3", "q4"])
+            self.assertIsNone(semantic_cache.lookup_answer(unit_vector(0), {}))
+            self.assertEqual(semantic_cache.lookup_answer(unit_vector(3), {}), "reply 3")
+            self.assertEqual(semantic_cache.lookup_answer(unit_vector(4), {}), "reply 4")
+
+    def test_unreadable_save_starts_empty(self):
+        os.makedirs(semantic_cache.CACHE_DIR, exist_ok=True)
+        with open(os.path.join(semantic_cache.CACHE_DIR, semantic_cache.CACHE_FILE), "wb") as file:
+            file.write(b"not a pickle")
+        with self.assertLogs(semantic_cache.log, level="WARNING"):
+            self.assertIsNone(semantic_cache.lookup_answer(unit_vector(0), {}))
+
+
+if __name__ == "__main__":
+    unittest.main()